@@ -0,0 +1,33 @@
+import pyaudio
+
+# 整个进程共用一个 PyAudio 实例，首次使用时创建
+_AUDIO = None
+
+
+def get_pyaudio():
+    """返回共享的 PyAudio 实例"""
+    global _AUDIO
+    if _AUDIO is None:
+        _AUDIO = pyaudio.PyAudio()
+    return _AUDIO
+
+
+def open_output_stream(rate, chunk, callback, format=pyaudio.paFloat32):
+    """在共享实例上打开单声道回调模式输出流 (不自动启动，由调用者负责关闭)"""
+    return get_pyaudio().open(
+        format=format,
+        channels=1,
+        rate=rate,
+        output=True,
+        frames_per_buffer=chunk,
+        stream_callback=callback,
+        start=False
+    )
+
+
+def terminate():
+    """释放共享的 PyAudio 实例 (程序退出时调用)"""
+    global _AUDIO
+    if _AUDIO is not None:
+        _AUDIO.terminate()
+        _AUDIO = None
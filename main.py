@@ -1,4 +1,6 @@
 import akshare as ak
+import array
+import math
 import numpy as np
 import pyaudio
 import threading
@@ -7,10 +9,14 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime
 
+import audio_output
+
 # 音频参数
 SAMPLE_RATE = 44100  # 采样率 (Hz)
 CHUNK = 1024  # 每次处理的音频块大小
 AMPLITUDE = 0.3  # 音量 (0.0 到 1.0)
+RING_CHUNKS = 8  # 环形缓冲可容纳的音频块数
+INT16_MAX = 32767  # 输出为16位整数PCM
 BASE_NOTE = 440.0  # A4 音符频率 (Hz)
 
 
@@ -23,32 +29,112 @@ def get_note_frequency(base_freq, semitones):
 # 创建音阶映射 (-12到+12个半音，对应-100%到+100%价格变化)
 NOTE_RANGE = 12  # 上下各12个半音（一个八度）
 NOTE_MAPPING = [get_note_frequency(BASE_NOTE, i) for i in range(-NOTE_RANGE, NOTE_RANGE + 1)]
+NOTE_MAPPING_NP = np.asarray(NOTE_MAPPING, dtype=np.float32)
+
+
+def build_note_buffer(freq):
+    """预计算单个音符的正弦波形 (整数个周期，首尾相接相位连续)"""
+    # 取至少覆盖一个CHUNK的整数个周期，长度取整带来的频率误差小于1音分
+    cycles = int(np.ceil(CHUNK * freq / SAMPLE_RATE))
+    length = int(round(cycles * SAMPLE_RATE / freq))
+
+    # 存两遍周期，任意偏移处截取CHUNK都不需要回绕拼接
+    n = np.arange(2 * length)
+    samples = AMPLITUDE * INT16_MAX * np.sin(2 * np.pi * cycles * n / length)
+    return np.rint(samples).astype(np.int16), length
+
+
+class AudioRingBuffer:
+    """单生产者单消费者的音频环形缓冲
+
+    读写位置只各自由一方修改，CPython 下整数赋值是原子的，无需加锁。
+    """
+
+    def __init__(self, size, block, dtype=np.int16):
+        self.size = size
+        self.buffer = np.zeros(size, dtype=dtype)
+        self.read_pos = 0  # 只由消费者(音频回调)修改
+        self.write_pos = 0  # 只由生产者线程修改
+
+        # 消费者独占的输出缓冲，每次读出的数据先复制到这里
+        self._out = np.zeros(block, dtype=dtype)
+
+    def free_space(self):
+        return self.size - (self.write_pos - self.read_pos)
+
+    def write(self, samples):
+        """写入一段采样，调用前需确认空间足够"""
+        n = len(samples)
+        start = self.write_pos % self.size
+        end = start + n
+        if end <= self.size:
+            self.buffer[start:end] = samples
+        else:
+            split = self.size - start
+            self.buffer[start:] = samples[:split]
+            self.buffer[:end - self.size] = samples[split:]
+        self.write_pos += n
+
+    def read(self, n):
+        """读出n个采样 (n不超过block)，数据不足时返回静音"""
+        out = self._out[:n]
+        if self.write_pos - self.read_pos < n:
+            out.fill(0)
+            return out
+
+        # 先复制再推进读位置，之后生产者才能覆盖这段空间
+        start = self.read_pos % self.size
+        end = start + n
+        if end <= self.size:
+            out[:] = self.buffer[start:end]
+        else:
+            split = self.size - start
+            out[:split] = self.buffer[start:]
+            out[split:] = self.buffer[:end - self.size]
+        self.read_pos += n
+        return out
+
+    def clear(self):
+        """清空缓冲 (仅在生产者和消费者都停止后调用)"""
+        self.read_pos = self.write_pos = 0
 
 
 class StockAudioSynth:
     def __init__(self):
         self.running = False
         self.thread = None
-        self.current_freq = BASE_NOTE
-        self.phase = 0.0
         self.playback_speed = 1.0
-        self.price_data = []
-        self.current_index = 0
+        self.times = np.empty(0, dtype=object)
+        self.prices = np.empty(0, dtype=np.float32)
+
+        # 与音频线程、UI共享的播放状态: [当前频率, 当前索引, 当前音符]
+        # array 的单元素读写在 GIL 下是原子的
+        self._pub = array.array('f', [BASE_NOTE, 0.0, NOTE_RANGE])
         self.last_update_time = time.time()
 
-        # 初始化 PyAudio
-        self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(
-            format=pyaudio.paFloat32,
-            channels=1,
-            rate=SAMPLE_RATE,
-            output=True,
-            frames_per_buffer=CHUNK
-        )
+        # 每个音符预先生成波形，播放时只需按偏移截取
+        self.note_buffers = []
+        self.note_periods = []
+        for freq in NOTE_MAPPING:
+            buf, period = build_note_buffer(freq)
+            self.note_buffers.append(buf)
+            self.note_periods.append(period)
+        self.note_offsets = [0] * len(NOTE_MAPPING)
+
+        # 生产者线程提前填充，音频回调只负责取出
+        self.ring = AudioRingBuffer(RING_CHUNKS * CHUNK, CHUNK)
+
+        # 换音时用一个CHUNK的线性淡入淡出消除爆音 (在 float32 中混合，写入环形缓冲时转回 int16)
+        self.prev_note = NOTE_RANGE
+        self._ramp = np.linspace(0, 1, CHUNK, dtype=np.float32)
+        self._mix = np.empty(CHUNK, dtype=np.float32)
+
+        # 打开输出流 (回调模式，由 PortAudio 音频线程按需取数据)
+        self.stream = audio_output.open_output_stream(SAMPLE_RATE, CHUNK, self._audio_cb, format=pyaudio.paInt16)
 
 
-    def load_stock_data(self, stock_code, date_str):
-        """从AKShare加载股票分时数据"""
+    def fetch_stock_data(self, stock_code, date_str):
+        """从AKShare获取股票分时数据 (可在后台线程调用，不修改合成器状态)"""
         try:
             if date_str.lower() == 'today':
                 date_str = datetime.now().strftime("%Y%m%d")
@@ -56,86 +142,129 @@ class StockAudioSynth:
             df = ak.stock_zh_a_hist_min_em(symbol=stock_code, start_date=date_str, end_date=date_str, period="1")
 
             if df.empty:
-                return False, "未获取到数据，请检查股票代码和日期"
+                return None, "未获取到数据，请检查股票代码和日期"
+            return df, ""
+        except Exception as e:
+            return None, f"数据加载失败: {str(e)}"
 
-            self.price_data = df[['时间', '收盘']].values.tolist()
+    def set_stock_data(self, df):
+        """装入分时数据 (须在UI线程调用，与播放进度、界面刷新串行)"""
+        try:
+            # 时间和价格分别存为连续数组
+            times = df['时间'].to_numpy()
+            prices = df['收盘'].to_numpy(dtype=np.float32)
 
             # 计算价格范围用于归一化
-            prices = [p[1] for p in self.price_data]
-            self.min_price = min(prices)
-            self.max_price = max(prices)
-            self.price_range = self.max_price - self.min_price
-
-            self.current_index = 0
-            return True, f"数据加载成功: {len(self.price_data)}个数据点"
+            min_price = float(prices.min())
+            max_price = float(prices.max())
+            price_range = max_price - min_price
+
+            # 整个序列一次性映射到音阶索引 (0到24)，播放时只需按索引取值
+            if price_range == 0:
+                notes = np.full(len(prices), NOTE_RANGE, dtype=np.int8)
+            else:
+                # [最低价, 最高价] 线性映射到 [0, 24]，等价于归一化到[-1, 1]后偏移12个半音
+                scaled = prices - min_price
+                scaled *= 2 * NOTE_RANGE / price_range
+                np.rint(scaled, out=scaled)
+                np.clip(scaled, 0, 2 * NOTE_RANGE, out=scaled)
+                notes = scaled.astype(np.int8)
         except Exception as e:
             return False, f"数据加载失败: {str(e)}"
 
+        self.min_price, self.max_price, self.price_range = min_price, max_price, price_range
+        self.notes = notes
+        self.freqs = NOTE_MAPPING_NP[notes]
+        self.times = times
+        self.prices = prices
+        self._pub[1] = 0.0
+        return True, f"数据加载成功: {len(self.prices)}个数据点"
+
     def start_playback(self):
-        if not self.running and self.price_data:
+        if not self.running and len(self.prices):
             self.running = True
-            self.thread = threading.Thread(target=self._generate_audio)
+            self.last_update_time = time.time()
+            self.thread = threading.Thread(target=self._fill_audio)
             self.thread.daemon = True
             self.thread.start()
+            self.stream.start_stream()
 
     def stop_playback(self):
         self.running = False
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=0.1)
+        if self.stream.is_active():
+            self.stream.stop_stream()
+        if not (self.thread and self.thread.is_alive()):
+            self.ring.clear()
 
     def set_playback_speed(self, speed):
         self.playback_speed = float(speed)
 
-    def _map_price_to_note(self, price):
-        """将价格映射到音阶"""
-        if self.price_range == 0:
-            return BASE_NOTE
-
-        # 归一化价格到[-1, 1]范围
-        normalized = 2 * (price - self.min_price) / self.price_range - 1
-
-        # 映射到半音索引 (-12到+12)
-        semitone = int(round(normalized * NOTE_RANGE))
-        semitone = max(-NOTE_RANGE, min(NOTE_RANGE, semitone))
-
-        return NOTE_MAPPING[semitone + NOTE_RANGE]  # 列表索引从0开始
-
-    def _generate_audio(self):
-        """生成音频数据的线程函数"""
-        while self.running and self.price_data:
-            # 更新当前索引
-            now = time.time()
-            elapsed = now - self.last_update_time
-            self.last_update_time = now
-
-            advance = elapsed * self.playback_speed * 2
-            self.current_index = min(len(self.price_data) - 1, self.current_index + advance)
-
-            current_idx = int(self.current_index)
-            if current_idx >= len(self.price_data) - 1:
-                current_idx = len(self.price_data) - 1
-                self.current_index = current_idx
-
-            # 获取当前价格并映射到音阶
-            _, current_price = self.price_data[current_idx]
-            self.current_freq = self._map_price_to_note(current_price)
-
-            # 生成正弦波
-            t = np.arange(CHUNK) / SAMPLE_RATE
-            samples = AMPLITUDE * np.sin(2 * np.pi * self.current_freq * t + self.phase)
-
-            # 更新相位
-            self.phase = (self.phase + 2 * np.pi * self.current_freq * CHUNK / SAMPLE_RATE) % (2 * np.pi)
+    def advance(self):
+        """按实际经过时间推进播放位置 (由UI主循环定时调用)"""
+        if not self.running or not len(self.prices):
+            return
 
-            # 播放音频
-            self.stream.write(samples.astype(np.float32).tobytes())
+        # 更新当前索引
+        now = time.time()
+        elapsed = now - self.last_update_time
+        self.last_update_time = now
+
+        advance = elapsed * self.playback_speed * 2
+        current_index = min(len(self.prices) - 1, self._pub[1] + advance)
+
+        current_idx = int(current_index)
+        if current_idx >= len(self.prices) - 1:
+            current_idx = len(self.prices) - 1
+            current_index = current_idx
+
+        # 取出预先映射好的音阶并发布
+        self._pub[0] = self.freqs[current_idx]
+        self._pub[1] = current_index
+        self._pub[2] = self.notes[current_idx]
+
+    def get_playback_state(self):
+        """返回 (当前频率, 当前索引)，供UI读取"""
+        freq, index, _ = self._pub
+        return freq, index
+
+    def _fill_audio(self):
+        """生产者线程: 保持环形缓冲尽量填满"""
+        while self.running:
+            if self.ring.free_space() < CHUNK:
+                time.sleep(CHUNK / SAMPLE_RATE / 2)
+                continue
+
+            note = int(self._pub[2])
+            samples = self._next_chunk(note)
+
+            if note != self.prev_note:
+                # 旧音符淡出、新音符淡入: mix = old + (new - old) * ramp
+                old = self._next_chunk(self.prev_note)
+                # 在 float32 中做减法，int16 相减可能溢出回绕
+                np.subtract(samples, old, out=self._mix, dtype=np.float32)
+                self._mix *= self._ramp
+                self._mix += old
+                np.rint(self._mix, out=self._mix)  # 先取整，写入 int16 缓冲时不再截断
+                samples = self._mix
+                self.prev_note = note
+
+            self.ring.write(samples)
+
+    def _next_chunk(self, note):
+        """从预计算波形中截取一个CHUNK，每个音符各自保持相位连续"""
+        offset = self.note_offsets[note]
+        self.note_offsets[note] = (offset + CHUNK) % self.note_periods[note]
+        return self.note_buffers[note][offset:offset + CHUNK]
+
+    def _audio_cb(self, in_data, frame_count, time_info, status):
+        """PortAudio 音频线程回调，从环形缓冲取出下一段音频数据"""
+        return self.ring.read(frame_count), pyaudio.paContinue
 
     def close(self):
         self.stop_playback()
-        if self.stream.is_active():
-            self.stream.stop_stream()
         self.stream.close()
-        self.p.terminate()
 
 
 class StockAudioApp:
@@ -146,8 +275,16 @@ class StockAudioApp:
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.synth = StockAudioSynth()
+
+        # 创建音符名称列表 (钢琴88键 A0到C8，按半音排列，八度在C处进位)
+        notes = ['A', 'A#', 'B', 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#']
+        self.note_names = [f"{notes[i % 12]}{(i + 9) // 12}" for i in range(88)]
+
         self.create_widgets()
 
+        # 播放进度由UI主循环驱动
+        self.tick()
+
     def create_widgets(self):
         main_frame = ttk.Frame(self.root, padding="20")
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -232,16 +369,61 @@ class StockAudioApp:
             messagebox.showerror("错误", "请输入股票代码")
             return
 
+        # 先在本地校验日期并统一为YYYYMMDD，避免无效输入也发起网络请求
+        if date_str.lower() != 'today':
+            # strptime 不要求补零，无分隔符的写法须恰好8位数字，避免 2024115 之类被歧义解析
+            if len(date_str) == 8 and date_str.isdigit():
+                formats = ("%Y%m%d",)
+            else:
+                formats = ("%Y-%m-%d", "%Y/%m/%d")
+            for fmt in formats:
+                try:
+                    date_str = datetime.strptime(date_str, fmt).strftime("%Y%m%d")
+                    break
+                except ValueError:
+                    continue
+            else:
+                messagebox.showerror("错误", "日期无效，格式应为 YYYYMMDD、YYYY-MM-DD、YYYY/MM/DD 或 today")
+                return
+
+        # 加载新数据前先停止播放，避免播放进度读到一半替换的数据
+        if self.synth.running:
+            self.stop_playback()
+
         self.status_label.config(text="正在加载数据...", foreground="blue")
-        self.root.update()
+        self.load_btn.config(state=tk.DISABLED)
+        self.play_btn.config(state=tk.DISABLED)
 
-        success, message = self.synth.load_stock_data(stock_code, date_str)
+        # 网络请求放到后台线程，界面保持响应
+        thread = threading.Thread(target=self._do_load, args=(stock_code, date_str))
+        thread.daemon = True
+        thread.start()
+
+    def _do_load(self, stock_code, date_str):
+        """后台获取数据，完成后交回UI线程装入"""
+        df, message = self.synth.fetch_stock_data(stock_code, date_str)
+        try:
+            self.root.after(0, lambda: self._loaded(df, message))
+        except (tk.TclError, RuntimeError):
+            # 加载期间窗口已关闭，结果直接丢弃
+            pass
+
+    def _loaded(self, df, message):
+        self.load_btn.config(state=tk.NORMAL)
+
+        # 在UI线程装入数据，不会与 update_ui、tick 交错
+        success = False
+        if df is not None:
+            success, message = self.synth.set_stock_data(df)
 
         if success:
             self.status_label.config(text=message, foreground="green")
             self.play_btn.config(state=tk.NORMAL)
         else:
             self.status_label.config(text=message, foreground="red")
+            # 加载失败时之前的数据仍然保留，可以继续播放
+            if len(self.synth.prices):
+                self.play_btn.config(state=tk.NORMAL)
 
     def start_playback(self):
         self.synth.start_playback()
@@ -262,29 +444,18 @@ class StockAudioApp:
 
     def get_note_name(self, freq):
         """获取最接近的音符名称"""
-        if not hasattr(self, 'note_names'):
-            # 创建音符名称列表 (A0到A8)
-            notes = ['A', 'A#', 'B', 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#']
-            self.note_names = []
-            for octave in range(0, 9):
-                for i, note in enumerate(notes):
-                    if note == 'B' and i == 2 and octave < 8:
-                        self.note_names.append(f"{note}{octave}")
-                    elif note.startswith('C') and i == 3 and octave < 8:
-                        self.note_names.append(f"{note}{octave}")
-                    elif octave < 8:
-                        self.note_names.append(f"{note}{octave}")
-
-        # 找到最接近的音符
-        closest_note = min(self.note_names,
-                           key=lambda x: abs(get_note_frequency(27.5, self.note_names.index(x)) - freq))
-        return closest_note
+        # 直接由频率算出相对A0(27.5Hz)的半音数
+        semitones = int(round(12 * math.log2(freq / 27.5)))
+        semitones = max(0, min(len(self.note_names) - 1, semitones))
+        return self.note_names[semitones]
 
     def update_ui(self):
-        if hasattr(self.synth, 'price_data') and self.synth.price_data:
-            current_idx = int(self.synth.current_index)
-            if current_idx < len(self.synth.price_data):
-                time_str, price = self.synth.price_data[current_idx]
+        if len(self.synth.prices):
+            freq, index = self.synth.get_playback_state()
+            current_idx = int(index)
+            if current_idx < len(self.synth.prices):
+                time_str = self.synth.times[current_idx]
+                price = self.synth.prices[current_idx]
                 self.data_info.config(text=f"时间: {time_str}  价格: {price:.2f}")
 
                 # 计算价格变化百分比
@@ -293,14 +464,19 @@ class StockAudioApp:
                     text=f"价格位置: {price_change:.1f}% (最低{self.synth.min_price:.2f}, 最高{self.synth.max_price:.2f})")
 
                 # 显示频率和音符
-                self.freq_info.config(text=f"当前频率: {self.synth.current_freq:.1f} Hz")
-                note_name = self.get_note_name(self.synth.current_freq)
+                self.freq_info.config(text=f"当前频率: {freq:.1f} Hz")
+                note_name = self.get_note_name(freq)
                 self.note_info.config(text=f"当前音符: {note_name}")
 
         self.root.after(100, self.update_ui)
 
+    def tick(self):
+        self.synth.advance()
+        self.root.after(20, self.tick)
+
     def on_close(self):
         self.synth.close()
+        audio_output.terminate()
         self.root.destroy()
 
 
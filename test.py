@@ -1,75 +1,107 @@
+import math
 import pyaudio
 import numpy as np
-import threading
-import time
 import tkinter as tk
 from tkinter import ttk
 
+import audio_output
+
 # 音频参数
 SAMPLE_RATE = 44100  # 采样率 (Hz)
 CHUNK = 1024  # 每次处理的音频块大小
 AMPLITUDE = 0.5  # 音量 (0.0 到 1.0)
 
+# 可选: 安装 numba 后使用 JIT 编译的正弦内核
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def fill_sine(out, omega, n0, phase0, amp):
+        """将从第 n0 个采样开始的正弦波写入 out (omega 为每采样的角频率)"""
+        start = (omega * n0 + phase0) % (2 * math.pi)
+        for i in range(out.shape[0]):
+            out[i] = amp * math.sin(start + omega * i)
+else:
+    fill_sine = None
+
 
 class AudioSynth:
     def __init__(self):
         self.running = False
-        self.thread = None
         self.frequency = 440.0  # 初始频率 (A4)
-        self.phase = 0.0
-
-        # 初始化 PyAudio
-        self.p = pyaudio.PyAudio()
-
-        # 打开音频流
-        self.stream = self.p.open(
-            format=pyaudio.paFloat32,
-            channels=1,
-            rate=SAMPLE_RATE,
-            output=True,
-            frames_per_buffer=CHUNK
-        )
+
+        # 相位由采样计数隐式决定，只在换音时调整初相
+        self.n_samples = 0
+        self.phase0 = 0.0
+        self._prev_freq = self.frequency
+        self._omega = 2 * np.pi * self.frequency / SAMPLE_RATE  # 每采样的角频率，换音时才重算
+
+        # 预分配计算缓冲区，避免每个音频块重新分配数组
+        self._n = np.arange(CHUNK, dtype=np.float32)
+        self._arg = np.empty(CHUNK, dtype=np.float32)
+        self._samples = np.empty(CHUNK, dtype=np.float32)
+
+        # 预先触发 JIT 编译，避免首次回调因编译耗时而断音
+        if fill_sine is not None:
+            fill_sine(self._samples, self._omega, 0, 0.0, AMPLITUDE)
+
+        # 打开音频流 (回调模式，由 PortAudio 音频线程按需生成数据)
+        self.stream = audio_output.open_output_stream(SAMPLE_RATE, CHUNK, self._audio_cb)
 
     def start(self):
-        """启动音频合成线程"""
+        """启动音频合成"""
         if not self.running:
             self.running = True
-            self.thread = threading.Thread(target=self._generate_audio)
-            self.thread.daemon = True
-            self.thread.start()
+            self.stream.start_stream()
 
     def stop(self):
         """停止音频合成"""
         self.running = False
-        if self.thread and self.thread.is_alive():
-            self.thread.join(timeout=0.1)
+        if self.stream.is_active():
+            self.stream.stop_stream()
 
     def set_frequency(self, freq):
         """设置新的频率"""
         self.frequency = float(freq)
 
-    def _generate_audio(self):
-        """生成音频数据的线程函数"""
-        while self.running:
-            # 计算时间向量
-            t = np.arange(CHUNK) / SAMPLE_RATE
-
-            # 生成正弦波
-            samples = AMPLITUDE * np.sin(2 * np.pi * self.frequency * t + self.phase)
-
-            # 更新相位以保持连续性
-            self.phase = (self.phase + 2 * np.pi * self.frequency * CHUNK / SAMPLE_RATE) % (2 * np.pi)
-
-            # 转换为32位浮点数并播放
-            self.stream.write(samples.astype(np.float32).tobytes())
+    def _audio_cb(self, in_data, frame_count, time_info, status):
+        """PortAudio 音频线程回调，生成下一段音频数据"""
+        freq = self.frequency
+        samples = self._samples[:frame_count]
+
+        if freq != self._prev_freq:
+            # 换音时重算角频率并调整初相，使新旧波形在当前采样处相位衔接
+            omega = 2 * np.pi * freq / SAMPLE_RATE
+            self.phase0 = (self.phase0 + (self._omega - omega) * self.n_samples) % (2 * np.pi)
+            self._omega = omega
+            self._prev_freq = freq
+
+        if fill_sine is not None:
+            # JIT 内核直接写入缓冲区
+            fill_sine(samples, self._omega, self.n_samples, self.phase0, AMPLITUDE)
+        else:
+            # 本块起始相位由采样计数直接算出，不随块累积误差
+            start = (self._omega * self.n_samples + self.phase0) % (2 * np.pi)
+
+            # 生成正弦波 (全部写入预分配的缓冲区)
+            arg = self._arg[:frame_count]
+            np.multiply(self._n[:frame_count], self._omega, out=arg)
+            arg += start
+            np.sin(arg, out=samples)
+            samples *= AMPLITUDE
+
+        self.n_samples += frame_count
+
+        # 直接把缓冲区交给 PortAudio，不再复制成 bytes
+        return samples, pyaudio.paContinue
 
     def close(self):
         """清理资源"""
         self.stop()
-        if self.stream.is_active():
-            self.stream.stop_stream()
         self.stream.close()
-        self.p.terminate()
 
 
 class AudioApp:
@@ -158,6 +190,7 @@ class AudioApp:
     def on_close(self):
         """关闭窗口时的清理工作"""
         self.synth.close()
+        audio_output.terminate()
         self.root.destroy()
 
 